@@ -6,10 +6,21 @@ SafeDocs - AI защита юридических документов
 """
 
 import os
-import io
+import re
+import sys
 import json
+import math
 import uuid
+import queue
+import hashlib
+import functools
+import asyncio
+import threading
 import logging
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import Counter
 from datetime import datetime
 from typing import List, Dict, Optional, Union
 from pathlib import Path
@@ -18,16 +29,38 @@ from pathlib import Path
 from fastapi import FastAPI, File, UploadFile, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import ORJSONResponse
+from starlette.exceptions import HTTPException as StarletteHTTPException
 from fastapi.encoders import jsonable_encoder
 
 # Data Models
-from pydantic import BaseModel, Field, validator
+from pydantic import BaseModel, Field
 
 # File Processing
-import PyPDF2
-from PIL import Image, ImageEnhance
-import pytesseract
+import aiofiles
+import pypdfium2 as pdfium
+import cv2
+import numpy as np
+from PIL import Image
+
+# Tesseract: один поток OpenMP на задачу, параллелизм обеспечивает пул экземпляров
+os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+from tesserocr import PyTessBaseAPI, OEM, PSM
+
+# Text Analysis (опционально: без pyahocorasick ключевые слова ищутся через str.find)
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+# Caching
+from cachetools import LRUCache
+
+# Session Storage (опционально: без redis сессии хранятся в памяти процесса)
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
 
 # Environment
 from dotenv import load_dotenv
@@ -129,6 +162,92 @@ class ChatResponse(BaseModel):
     relevant_sections: List[str] = Field(default_factory=list, description="Релевантные секции")
     document_id: str = Field(..., description="ID документа")
 
+# ============================================================================
+# ПУЛЫ ОБРАБОТКИ
+# ============================================================================
+
+# Количество экземпляров Tesseract (по одному на параллельную задачу OCR).
+# Каждый экземпляр держит свою копию моделей rus+eng в каждом процессе uvicorn
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "2"))
+
+# Максимальное ожидание свободного экземпляра Tesseract (секунды)
+OCR_POOL_TIMEOUT = 60
+
+_tess_api_pool: Optional["queue.Queue[PyTessBaseAPI]"] = None
+_tess_api_pool_lock = threading.Lock()
+
+def get_tess_api_pool() -> "queue.Queue[PyTessBaseAPI]":
+    """Пул долгоживущих экземпляров Tesseract (создается один раз, прогревается при старте)"""
+    global _tess_api_pool
+    
+    if _tess_api_pool is not None:
+        return _tess_api_pool
+    
+    # Блокировка: параллельные задачи OCR не создают собственные копии пула
+    with _tess_api_pool_lock:
+        if _tess_api_pool is None:
+            # Языковые модели rus+eng загружаются один раз, а не при каждом запросе.
+            # Только LSTM без ограничения набора символов и с автоматической сегментацией
+            # страницы (договоры обычно состоят из нескольких блоков). Папка моделей задается
+            # через TESSDATA_PREFIX - например, tessdata_fast для более быстрого распознавания
+            apis = []
+            
+            try:
+                for _ in range(OCR_WORKERS):
+                    apis.append(PyTessBaseAPI(lang='rus+eng', oem=OEM.LSTM_ONLY, psm=PSM.AUTO))
+            except Exception:
+                # Освобождение уже созданных экземпляров при частичной инициализации
+                for api in apis:
+                    api.End()
+                raise
+            
+            tess_api_pool = queue.Queue()
+            for api in apis:
+                tess_api_pool.put(api)
+            
+            _tess_api_pool = tess_api_pool
+    
+    return _tess_api_pool
+
+# Количество процессов для разбора PDF
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", os.cpu_count() or 1))
+
+# CPU-нагруженное извлечение текста выполняется вне цикла событий:
+# tesserocr освобождает GIL, поэтому для OCR достаточно потоков,
+# PDFium не потокобезопасен, поэтому PDF разбирается в отдельных процессах
+OCR_POOL = ThreadPoolExecutor(max_workers=OCR_WORKERS, thread_name_prefix="ocr")
+
+# Процессы PDF не форкаются от работающего многопоточного сервера:
+# forkserver (или spawn, где он недоступен) запускает их из чистого процесса
+PDF_MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+def create_pdf_pool() -> ProcessPoolExecutor:
+    """Создание пула процессов для разбора PDF"""
+    return ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=PDF_MP_CONTEXT)
+
+PDF_POOL = create_pdf_pool()
+
+async def run_in_pdf_pool(func, *args):
+    """Выполнение задачи в пуле PDF; после падения процесса пул пересоздается"""
+    global PDF_POOL
+    
+    loop = asyncio.get_running_loop()
+    pool = PDF_POOL
+    
+    try:
+        return await loop.run_in_executor(pool, func, *args)
+    except BrokenProcessPool:
+        # Пул пересоздается один раз, даже если упало несколько параллельных задач
+        if PDF_POOL is pool:
+            logger.warning(f"Процесс разбора PDF завершился аварийно на файле {args[0] if args else '?'} - пул пересоздан")
+            PDF_POOL = create_pdf_pool()
+            pool.shutdown(wait=False)
+        
+        # Задача не повторяется: PDF, роняющий PDFium, уронил бы и новый пул
+        raise Exception("Не удалось разобрать PDF: процесс обработки завершился аварийно")
+
 # ============================================================================
 # ОБРАБОТКА ФАЙЛОВ
 # ============================================================================
@@ -150,6 +269,24 @@ class FileProcessor:
     # Максимальный размер файла (20MB)
     MAX_FILE_SIZE = 20 * 1024 * 1024
     
+    # Размер блока при потоковой записи загрузки (64KB)
+    CHUNK_SIZE = 64 * 1024
+    
+    # Папка для временного хранения загруженных файлов
+    UPLOAD_DIR = Path("storage") / "uploads"
+    
+    # Сохранять загруженные файлы после обработки (для аудита)
+    PERSIST_UPLOADS = os.getenv("SAFEDOCS_PERSIST_UPLOADS", "").strip().lower() in {"1", "true", "yes"}
+    
+    # Минимальная ширина изображения для OCR (меньшие масштабируются)
+    OCR_MIN_WIDTH = 1000
+    
+    # Максимальный размер изображения для OCR в пикселях (A4 при 600 dpi - около 35 Мп)
+    OCR_MAX_PIXELS = 50_000_000
+    
+    # Минимальное количество страниц PDF в одной задаче пула процессов
+    PDF_MIN_PAGES_PER_TASK = 8
+    
     @staticmethod
     def validate_file(file: UploadFile) -> Dict[str, any]:
         """Валидация загруженного файла"""
@@ -173,40 +310,59 @@ class FileProcessor:
         }
     
     @staticmethod
-    async def process_file(file: UploadFile) -> Dict[str, any]:
-        """Обработка файла и извлечение текста"""
+    async def receive_file(file: UploadFile) -> Dict[str, any]:
+        """Прием файла: валидация и потоковая запись на диск"""
         
         # Валидация
         file_info = FileProcessor.validate_file(file)
         
-        # Чтение содержимого
-        try:
-            file_content = await file.read()
-        except Exception as e:
-            logger.error(f"Ошибка чтения файла: {e}")
-            raise HTTPException(status_code=400, detail="Ошибка чтения файла")
-        
-        # Проверка размера
-        if len(file_content) > FileProcessor.MAX_FILE_SIZE:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Файл слишком большой: {len(file_content)} байт. "
-                       f"Максимум: {FileProcessor.MAX_FILE_SIZE} байт"
-            )
+        # Потоковая запись на диск без буферизации всего файла в памяти
+        file_path, file_size, digest = await FileProcessor._save_upload(file)
         
-        if len(file_content) == 0:
+        if file_size == 0:
+            file_path.unlink(missing_ok=True)
             raise HTTPException(status_code=400, detail="Файл пустой")
         
-        # Извлечение текста
-        file_type = file_info['file_type']
+        return {
+            **file_info,
+            'file_path': file_path,
+            'file_size': file_size,
+            'digest': digest
+        }
+    
+    @staticmethod
+    def remove_upload(upload: Dict[str, any]) -> None:
+        """Удаление временного файла загрузки (или сохранение под хешем содержимого)"""
+        file_path = upload['file_path']
+        
+        if not FileProcessor.PERSIST_UPLOADS:
+            file_path.unlink(missing_ok=True)
+            return
+        
+        # Имя по хешу содержимого: повторные загрузки не создают копий
+        try:
+            file_path.replace(FileProcessor.UPLOAD_DIR / f"{upload['digest']}{file_path.suffix}")
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить загруженный файл: {e}")
+            file_path.unlink(missing_ok=True)
+    
+    @staticmethod
+    async def process_file(upload: Dict[str, any]) -> Dict[str, any]:
+        """Извлечение текста из принятого файла"""
+        
+        file_path = upload['file_path']
+        file_type = upload['file_type']
+        loop = asyncio.get_running_loop()
         
         try:
             if file_type == 'pdf':
-                text = FileProcessor._extract_from_pdf(file_content)
+                text = await FileProcessor._extract_from_pdf(file_path)
             elif file_type == 'image':
-                text = FileProcessor._extract_from_image(file_content)
+                text = await loop.run_in_executor(OCR_POOL, FileProcessor._extract_from_image, file_path)
             elif file_type == 'text':
-                text = FileProcessor._extract_from_text(file_content)
+                async with aiofiles.open(file_path, 'rb') as f:
+                    content = await f.read()
+                text = FileProcessor._extract_from_text(content)
             else:
                 raise HTTPException(status_code=400, detail=f"Обработка {file_type} пока не поддерживается")
             
@@ -220,8 +376,8 @@ class FileProcessor:
             return {
                 'text': text.strip(),
                 'file_type': file_type,
-                'filename': file_info['filename'],
-                'file_size': len(file_content),
+                'filename': upload['filename'],
+                'file_size': upload['file_size'],
                 'word_count': len(text.split())
             }
             
@@ -232,20 +388,95 @@ class FileProcessor:
             raise HTTPException(status_code=500, detail=f"Ошибка обработки файла: {str(e)}")
     
     @staticmethod
-    def _extract_from_pdf(content: bytes) -> str:
-        """Извлечение текста из PDF"""
+    async def _save_upload(file: UploadFile) -> tuple:
+        """Потоковая запись загруженного файла на диск с проверкой размера и хешированием"""
+        
+        FileProcessor.UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+        file_path = FileProcessor.UPLOAD_DIR / f"tmp_{uuid.uuid4().hex}{Path(file.filename).suffix}"
+        file_size = 0
+        hasher = hashlib.blake2b(digest_size=16)
+        
+        try:
+            async with aiofiles.open(file_path, 'wb') as f:
+                while chunk := await file.read(FileProcessor.CHUNK_SIZE):
+                    file_size += len(chunk)
+                    
+                    # Проверка размера без чтения оставшейся части
+                    if file_size > FileProcessor.MAX_FILE_SIZE:
+                        raise HTTPException(
+                            status_code=400,
+                            detail=f"Файл слишком большой. "
+                                   f"Максимум: {FileProcessor.MAX_FILE_SIZE} байт"
+                        )
+                    
+                    hasher.update(chunk)
+                    await f.write(chunk)
+        except HTTPException:
+            file_path.unlink(missing_ok=True)
+            raise
+        except Exception as e:
+            file_path.unlink(missing_ok=True)
+            logger.error(f"Ошибка чтения файла: {e}")
+            raise HTTPException(status_code=400, detail="Ошибка чтения файла")
+        
+        return file_path, file_size, hasher.hexdigest()
+    
+    @staticmethod
+    async def _extract_from_pdf(file_path: Path) -> str:
+        """Извлечение текста из PDF (диапазоны страниц обрабатываются параллельно)"""
         try:
-            pdf_file = io.BytesIO(content)
-            pdf_reader = PyPDF2.PdfReader(pdf_file)
+            min_pages = FileProcessor.PDF_MIN_PAGES_PER_TASK
+            
+            # Первый диапазон заодно возвращает количество страниц:
+            # небольшой PDF обрабатывается одной задачей
+            page_count, first_part = await run_in_pdf_pool(
+                FileProcessor._extract_pdf_pages, file_path, 0, min_pages
+            )
             
-            if len(pdf_reader.pages) == 0:
+            if page_count == 0:
                 raise Exception("PDF не содержит страниц")
             
+            # Остальные страницы делятся примерно на PDF_WORKERS диапазонов:
+            # каждое открытие документа стоит пропорционально его размеру,
+            # поэтому количество открытий не должно расти с числом страниц
+            pages_per_task = max(min_pages, math.ceil((page_count - min_pages) / PDF_WORKERS))
+            
+            other_parts = await asyncio.gather(*[
+                run_in_pdf_pool(FileProcessor._extract_pdf_pages, file_path, start, start + pages_per_task)
+                for start in range(min_pages, page_count, pages_per_task)
+            ])
+            
+            full_text = "".join([first_part, *(part for _, part in other_parts)])
+            
+            if not full_text.strip():
+                raise Exception("PDF не содержит извлекаемого текста")
+            
+            return full_text.strip()
+            
+        except Exception as e:
+            raise Exception(f"Ошибка обработки PDF: {str(e)}")
+    
+    @staticmethod
+    def _extract_pdf_pages(file_path: Path, start: int, stop: int) -> tuple:
+        """Извлечение текста из страниц PDF с start по stop (не включая) и количество страниц"""
+        pdf = pdfium.PdfDocument(str(file_path))
+        
+        try:
+            page_count = len(pdf)
             text_parts = []
             
-            for page_num, page in enumerate(pdf_reader.pages, 1):
+            for page_index in range(start, min(stop, page_count)):
+                page_num = page_index + 1
+                
                 try:
-                    page_text = page.extract_text()
+                    page = pdf[page_index]
+                    textpage = page.get_textpage()
+                    try:
+                        page_text = textpage.get_text_range()
+                    finally:
+                        textpage.close()
+                        page.close()
+                    
                     if page_text.strip():
                         text_parts.append(f"\n=== Страница {page_num} ===\n")
                         text_parts.append(page_text)
@@ -254,69 +485,73 @@ class FileProcessor:
                     logger.warning(f"Ошибка извлечения текста со страницы {page_num}: {e}")
                     continue
             
-            full_text = "".join(text_parts)
-            
-            if not full_text.strip():
-                raise Exception("PDF не содержит извлекаемого текста")
-            
-            return full_text.strip()
-            
-        except Exception as e:
-            raise Exception(f"Ошибка обработки PDF: {str(e)}")
+            return page_count, "".join(text_parts)
+        finally:
+            pdf.close()
     
     @staticmethod
-    def _extract_from_image(content: bytes) -> str:
+    def _extract_from_image(file_path: Path) -> str:
         """Высококачественное OCR для изображений"""
         try:
-            # Открытие изображения
-            image = Image.open(io.BytesIO(content))
+            # Размер читается из заголовка до декодирования (защита от "бомб распаковки")
+            try:
+                with Image.open(file_path) as pil_image:
+                    width, height = pil_image.size
+                    if width * height > FileProcessor.OCR_MAX_PIXELS:
+                        raise HTTPException(
+                            status_code=400,
+                            detail=f"Изображение слишком большое: {width}x{height}. "
+                                   f"Максимум: {FileProcessor.OCR_MAX_PIXELS} пикселей"
+                        )
+                    
+                    # Декодирование сразу в оттенках серого
+                    image = np.asarray(pil_image.convert('L'))
+            except Image.DecompressionBombError:
+                raise HTTPException(status_code=400, detail="Изображение слишком большое")
             
-            # Конвертация в RGB если нужно
-            if image.mode not in ('RGB', 'L'):
-                image = image.convert('RGB')
+            # Подготовка изображения: масштабирование и бинаризация
+            image = FileProcessor._prepare_image_for_ocr(image)
             
-            # Улучшение качества изображения
-            image = FileProcessor._enhance_image_for_ocr(image)
+            # OCR на экземпляре из пула (модели уже загружены)
+            tess_api_pool = get_tess_api_pool()
             
-            # OCR с оптимизированными настройками
-            custom_config = r'--oem 3 --psm 6 -l rus+eng'
+            try:
+                api = tess_api_pool.get(timeout=OCR_POOL_TIMEOUT)
+            except queue.Empty:
+                raise Exception("OCR недоступен: нет свободного экземпляра Tesseract")
             
             try:
-                text = pytesseract.image_to_string(image, config=custom_config)
-            except Exception as ocr_error:
-                logger.warning(f"OCR с конфигурацией не удался: {ocr_error}")
-                # Fallback - простой OCR
-                text = pytesseract.image_to_string(image, lang='rus+eng')
+                api.SetImage(image)
+                text = api.GetUTF8Text()
+            finally:
+                tess_api_pool.put(api)
             
             if not text.strip():
                 raise Exception("Не удалось распознать текст на изображении")
             
             return text.strip()
             
+        except HTTPException:
+            raise
         except Exception as e:
             raise Exception(f"Ошибка OCR: {str(e)}")
     
     @staticmethod
-    def _enhance_image_for_ocr(image: Image.Image) -> Image.Image:
-        """Улучшение изображения для лучшего OCR"""
-        
-        # Масштабирование для улучшения качества
-        width, height = image.size
-        if width < 1500:
-            scale_factor = 1500 / width
-            new_width = int(width * scale_factor)
-            new_height = int(height * scale_factor)
-            image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+    def _prepare_image_for_ocr(image: np.ndarray) -> Image.Image:
+        """Подготовка изображения для OCR"""
         
-        # Повышение контрастности
-        enhancer = ImageEnhance.Contrast(image)
-        image = enhancer.enhance(1.2)
+        # Масштабирование только для изображений низкого разрешения
+        height, width = image.shape
+        if width < FileProcessor.OCR_MIN_WIDTH:
+            scale_factor = FileProcessor.OCR_MIN_WIDTH / width
+            new_height = int(height * scale_factor)
+            image = cv2.resize(image, (FileProcessor.OCR_MIN_WIDTH, new_height), interpolation=cv2.INTER_CUBIC)
         
-        # Повышение резкости
-        enhancer = ImageEnhance.Sharpness(image)
-        image = enhancer.enhance(1.1)
+        # Бинаризация методом Оцу: Tesseract получает одноканальное изображение
+        # и пропускает собственную бинаризацию
+        _, image = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
         
-        return image
+        return Image.fromarray(image)
     
     @staticmethod
     def _extract_from_text(content: bytes) -> str:
@@ -433,14 +668,17 @@ class DocumentAnalyzer:
             # Предобработка текста
             text_lower = text.lower()
             
+            # Поиск всех ключевых слов за один проход
+            positions = DocumentAnalyzer._find_first_positions(text_lower)
+            
             # Анализ рисков
-            risks = DocumentAnalyzer._analyze_risks(text, text_lower)
+            risks = DocumentAnalyzer._analyze_risks(text, positions)
             
             # Анализ выгод
-            benefits = DocumentAnalyzer._analyze_benefits(text, text_lower)
+            benefits = DocumentAnalyzer._analyze_benefits(text, positions)
             
             # Анализ неясных терминов
-            unclear_terms = DocumentAnalyzer._analyze_unclear_terms(text, text_lower)
+            unclear_terms = DocumentAnalyzer._analyze_unclear_terms(text, positions)
             
             # Создание подсветки
             highlights = DocumentAnalyzer._create_highlights(risks, benefits, unclear_terms)
@@ -482,120 +720,147 @@ class DocumentAnalyzer:
             raise HTTPException(status_code=500, detail=f"Ошибка анализа: {str(e)}")
     
     @staticmethod
-    def _analyze_risks(text: str, text_lower: str) -> List[RiskData]:
+    def _analyze_risks(text: str, positions: Dict[str, int]) -> List[RiskData]:
         """Анализ рисков в документе"""
         risks = []
         
         for risk_type, pattern_data in DocumentAnalyzer.RISK_PATTERNS.items():
             for keyword in pattern_data["keywords"]:
-                positions = DocumentAnalyzer._find_all_positions(text_lower, keyword)
+                pos = positions.get(keyword)
+                if pos is None:
+                    continue
                 
-                for pos in positions:
-                    context = DocumentAnalyzer._extract_context(text, pos, len(keyword))
-                    
-                    risk = RiskData(
-                        type=risk_type.replace("_", " ").title(),
-                        keyword=keyword,
-                        context=context,
-                        position=pos,
-                        severity=pattern_data["severity"],
-                        recommendation=DocumentAnalyzer._get_risk_recommendation(risk_type, keyword),
-                        legal_reference=DocumentAnalyzer._get_legal_reference(risk_type)
-                    )
-                    
-                    risks.append(risk)
-                    # Один риск на тип для избежания дублирования
-                    break
+                context = DocumentAnalyzer._extract_context(text, pos, len(keyword))
+                
+                risk = RiskData(
+                    type=risk_type.replace("_", " ").title(),
+                    keyword=keyword,
+                    context=context,
+                    position=pos,
+                    severity=pattern_data["severity"],
+                    recommendation=DocumentAnalyzer._get_risk_recommendation(risk_type, keyword),
+                    legal_reference=DocumentAnalyzer._get_legal_reference(risk_type)
+                )
                 
-                if risks and risks[-1].type == risk_type.replace("_", " ").title():
-                    break
+                risks.append(risk)
+                # Один риск на тип для избежания дублирования
+                break
         
         return risks
     
     @staticmethod
-    def _analyze_benefits(text: str, text_lower: str) -> List[BenefitData]:
+    def _analyze_benefits(text: str, positions: Dict[str, int]) -> List[BenefitData]:
         """Анализ выгодных условий"""
         benefits = []
         
         for benefit_type, pattern_data in DocumentAnalyzer.BENEFIT_PATTERNS.items():
             for keyword in pattern_data["keywords"]:
-                positions = DocumentAnalyzer._find_all_positions(text_lower, keyword)
+                pos = positions.get(keyword)
+                if pos is None:
+                    continue
                 
-                for pos in positions:
-                    context = DocumentAnalyzer._extract_context(text, pos, len(keyword))
-                    
-                    benefit = BenefitData(
-                        type=benefit_type.replace("_", " ").title(),
-                        keyword=keyword,
-                        context=context,
-                        position=pos,
-                        value=pattern_data["value"],
-                        description=pattern_data["description"]
-                    )
-                    
-                    benefits.append(benefit)
-                    break
+                context = DocumentAnalyzer._extract_context(text, pos, len(keyword))
                 
-                if benefits and benefits[-1].type == benefit_type.replace("_", " ").title():
-                    break
+                benefit = BenefitData(
+                    type=benefit_type.replace("_", " ").title(),
+                    keyword=keyword,
+                    context=context,
+                    position=pos,
+                    value=pattern_data["value"],
+                    description=pattern_data["description"]
+                )
+                
+                benefits.append(benefit)
+                break
         
         return benefits
     
     @staticmethod
-    def _analyze_unclear_terms(text: str, text_lower: str) -> List[UnclearTermData]:
+    def _analyze_unclear_terms(text: str, positions: Dict[str, int]) -> List[UnclearTermData]:
         """Анализ неясных терминов"""
         unclear_terms = []
         
         for phrase in DocumentAnalyzer.UNCLEAR_PATTERNS:
-            positions = DocumentAnalyzer._find_all_positions(text_lower, phrase)
+            pos = positions.get(phrase)
+            if pos is None:
+                continue
             
-            for pos in positions:
-                context = DocumentAnalyzer._extract_context(text, pos, len(phrase))
-                
-                unclear_term = UnclearTermData(
-                    phrase=phrase,
-                    context=context,
-                    position=pos,
-                    explanation=f"Фраза '{phrase}' требует конкретизации",
-                    suggestion=DocumentAnalyzer._get_unclear_suggestion(phrase),
-                    legal_clarification=DocumentAnalyzer._get_legal_clarification(phrase)
-                )
-                
-                unclear_terms.append(unclear_term)
-                break  # Один термин на фразу
+            context = DocumentAnalyzer._extract_context(text, pos, len(phrase))
+            
+            unclear_term = UnclearTermData(
+                phrase=phrase,
+                context=context,
+                position=pos,
+                explanation=f"Фраза '{phrase}' требует конкретизации",
+                suggestion=DocumentAnalyzer._get_unclear_suggestion(phrase),
+                legal_clarification=DocumentAnalyzer._get_legal_clarification(phrase)
+            )
+            
+            unclear_terms.append(unclear_term)  # Один термин на фразу
         
         return unclear_terms
     
     @staticmethod
-    def _find_all_positions(text: str, keyword: str) -> List[int]:
-        """Поиск всех позиций ключевого слова"""
-        positions = []
-        start = 0
-        
-        while True:
-            pos = text.find(keyword, start)
-            if pos == -1:
-                break
-            positions.append(pos)
-            start = pos + 1
+    @functools.cache
+    def _get_keywords() -> tuple:
+        """Все ключевые слова анализатора без повторов (собираются один раз)"""
+        keywords = [
+            keyword
+            for patterns in (DocumentAnalyzer.RISK_PATTERNS, DocumentAnalyzer.BENEFIT_PATTERNS)
+            for pattern_data in patterns.values()
+            for keyword in pattern_data["keywords"]
+        ]
+        keywords.extend(DocumentAnalyzer.UNCLEAR_PATTERNS)
+        
+        return tuple(dict.fromkeys(keywords))
+    
+    @staticmethod
+    @functools.cache
+    def _get_keyword_automaton():
+        """Автомат Ахо-Корасик по ключевым словам (строится один раз, None без pyahocorasick)"""
+        if ahocorasick is None:
+            return None
+        
+        automaton = ahocorasick.Automaton()
         
-        return positions[:3]  # Максимум 3 вхождения
+        for keyword in DocumentAnalyzer._get_keywords():
+            automaton.add_word(keyword, keyword)
+        
+        automaton.make_automaton()
+        return automaton
+    
+    @staticmethod
+    def _find_first_positions(text: str) -> Dict[str, int]:
+        """Позиции первого вхождения каждого ключевого слова"""
+        positions = {}
+        automaton = DocumentAnalyzer._get_keyword_automaton()
+        
+        if automaton is not None:
+            # Один проход по тексту для всех слов
+            for end_index, keyword in automaton.iter(text):
+                if keyword not in positions:
+                    positions[keyword] = end_index - len(keyword) + 1
+        else:
+            # Один вызов find на слово
+            for keyword in DocumentAnalyzer._get_keywords():
+                pos = text.find(keyword)
+                if pos != -1:
+                    positions[keyword] = pos
+        
+        return positions
     
     @staticmethod
     def _extract_context(text: str, position: int, keyword_length: int, context_size: int = 150) -> str:
         """Извлечение контекста вокруг найденного слова"""
+        text_length = len(text)
         start = max(0, position - context_size)
-        end = min(len(text), position + keyword_length + context_size)
-        
-        context = text[start:end].strip()
+        end = min(text_length, position + keyword_length + context_size)
         
-        # Добавляем троеточие если контекст обрезан
-        if start > 0:
-            context = "..." + context
-        if end < len(text):
-            context = context + "..."
+        # Добавляем троеточие если контекст обрезан (строка собирается один раз)
+        prefix = "..." if start > 0 else ""
+        suffix = "..." if end < text_length else ""
         
-        return context
+        return f"{prefix}{text[start:end].strip()}{suffix}"
     
     @staticmethod
     def _create_highlights(risks: List[RiskData], benefits: List[BenefitData], unclear_terms: List[UnclearTermData]) -> List[HighlightData]:
@@ -703,30 +968,34 @@ class DocumentAnalyzer:
     def _create_summary(filename: str, risks: List[RiskData], benefits: List[BenefitData], unclear_terms: List[UnclearTermData], overall_rating: str) -> str:
         """Создание краткого резюме"""
         
-        high_risks = len([r for r in risks if r.severity == "высокий"])
-        medium_risks = len([r for r in risks if r.severity == "средний"])
+        # Подсчет рисков по уровням за один проход
+        severity_counts = Counter(r.severity for r in risks)
+        high_risks = severity_counts["высокий"]
+        medium_risks = severity_counts["средний"]
         
-        summary = f"""📋 АНАЛИЗ ДОКУМЕНТА: {filename}
-
-🎯 ОБЩАЯ ОЦЕНКА: {overall_rating.upper()}
-
-📊 СТАТИСТИКА:
-• Всего рисков: {len(risks)}
-  - Высокие: {high_risks}
-  - Средние: {medium_risks}
-• Выгодные условия: {len(benefits)}
-• Неясные формулировки: {len(unclear_terms)}
-
-💡 КЛЮЧЕВЫЕ МОМЕНТЫ:
-{DocumentAnalyzer._get_key_points(risks, benefits, unclear_terms)}
-
-⚖️ РЕКОМЕНДАЦИЯ:
-{DocumentAnalyzer._get_main_recommendation(overall_rating, high_risks)}
-
-📋 Данный анализ основан на автоматическом поиске ключевых слов и фраз. 
-Для окончательного решения рекомендуется консультация с юристом."""
+        summary_lines = [
+            f"📋 АНАЛИЗ ДОКУМЕНТА: {filename}",
+            "",
+            f"🎯 ОБЩАЯ ОЦЕНКА: {overall_rating.upper()}",
+            "",
+            "📊 СТАТИСТИКА:",
+            f"• Всего рисков: {len(risks)}",
+            f"  - Высокие: {high_risks}",
+            f"  - Средние: {medium_risks}",
+            f"• Выгодные условия: {len(benefits)}",
+            f"• Неясные формулировки: {len(unclear_terms)}",
+            "",
+            "💡 КЛЮЧЕВЫЕ МОМЕНТЫ:",
+            DocumentAnalyzer._get_key_points(risks, benefits, unclear_terms),
+            "",
+            "⚖️ РЕКОМЕНДАЦИЯ:",
+            DocumentAnalyzer._get_main_recommendation(overall_rating, high_risks),
+            "",
+            "📋 Данный анализ основан на автоматическом поиске ключевых слов и фраз. ",
+            "Для окончательного решения рекомендуется консультация с юристом."
+        ]
         
-        return summary.strip()
+        return "\n".join(summary_lines)
     
     @staticmethod
     def _get_key_points(risks: List[RiskData], benefits: List[BenefitData], unclear_terms: List[UnclearTermData]) -> str:
@@ -822,8 +1091,9 @@ class DocumentManager:
         try:
             file_path = self.analysis_dir / f"{analysis.document_id}.json"
             
+            # Сериализация в pydantic-core без промежуточного dict
             with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(analysis.dict(), f, ensure_ascii=False, indent=2)
+                f.write(analysis.model_dump_json(indent=2))
             
             logger.info(f"Анализ сохранен: {file_path}")
             return str(file_path)
@@ -841,9 +1111,7 @@ class DocumentManager:
                 return None
             
             with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            return DocumentAnalysis(**data)
+                return DocumentAnalysis.model_validate_json(f.read())
             
         except Exception as e:
             logger.error(f"Ошибка загрузки анализа {document_id}: {e}")
@@ -881,6 +1149,62 @@ class DocumentManager:
             logger.error(f"Ошибка получения списка анализов: {e}")
             return []
 
+class SessionStorage:
+    """Хранилище результатов анализа текущих сессий (Redis или память процесса)"""
+    
+    # Префикс ключей и время жизни записей в Redis (24 часа)
+    KEY_PREFIX = "doc:"
+    TTL_SECONDS = 24 * 60 * 60
+    
+    # Индекс документов: sorted set с временем истечения записи в качестве score
+    INDEX_KEY = "doc:index"
+    
+    def __init__(self, redis_url: Optional[str] = None):
+        self.redis = None
+        self.local_storage: Dict[str, DocumentAnalysis] = {}
+        
+        if redis_url:
+            if aioredis is None:
+                logger.warning("REDIS_URL задан, но пакет redis не установлен - сессии хранятся в памяти")
+            else:
+                self.redis = aioredis.from_url(redis_url)
+    
+    async def set(self, analysis: DocumentAnalysis) -> None:
+        """Сохранение результата анализа в сессии"""
+        if self.redis is not None:
+            expires_at = datetime.now().timestamp() + self.TTL_SECONDS
+            
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.set(
+                    f"{self.KEY_PREFIX}{analysis.document_id}",
+                    analysis.model_dump_json(),
+                    ex=self.TTL_SECONDS
+                )
+                pipe.zadd(self.INDEX_KEY, {analysis.document_id: expires_at})
+                await pipe.execute()
+        else:
+            self.local_storage[analysis.document_id] = analysis
+    
+    async def get(self, document_id: str) -> Optional[DocumentAnalysis]:
+        """Получение результата анализа из сессии"""
+        if self.redis is not None:
+            raw = await self.redis.get(f"{self.KEY_PREFIX}{document_id}")
+            return DocumentAnalysis.model_validate_json(raw) if raw else None
+        
+        return self.local_storage.get(document_id)
+    
+    async def count(self) -> int:
+        """Количество документов в сессиях"""
+        if self.redis is not None:
+            # Удаление истекших записей из индекса и подсчет без обхода всех ключей
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.zremrangebyscore(self.INDEX_KEY, "-inf", datetime.now().timestamp())
+                pipe.zcard(self.INDEX_KEY)
+                _, count = await pipe.execute()
+            return count
+        
+        return len(self.local_storage)
+
 # ============================================================================
 # WEB ПРИЛОЖЕНИЕ
 # ============================================================================
@@ -891,7 +1215,8 @@ app = FastAPI(
     description="Профессиональный анализ договоров с фокусом на казахстанское законодательство",
     version="2.0.0",
     docs_url="/api/docs",
-    redoc_url="/api/redoc"
+    redoc_url="/api/redoc",
+    default_response_class=ORJSONResponse
 )
 
 # Настройка CORS
@@ -906,8 +1231,13 @@ app.add_middleware(
 # Инициализация компонентов
 document_manager = DocumentManager()
 
-# Временное хранилище для сессий (в продакшене - Redis)
-session_storage = {}
+# Хранилище сессий: Redis при заданном REDIS_URL, общий для всех воркеров
+session_storage = SessionStorage(os.getenv("REDIS_URL"))
+
+# Кэш извлеченного текста по хешу и типу файла. Размер ограничен объемом
+# текста в памяти (TEXT_CACHE_MAX_MB), а не количеством записей
+TEXT_CACHE_MAX_BYTES = int(os.getenv("TEXT_CACHE_MAX_MB", "64")) * 1024 * 1024
+text_cache = LRUCache(maxsize=TEXT_CACHE_MAX_BYTES, getsizeof=lambda file_data: sys.getsizeof(file_data['text']))
 
 # Подключение статических файлов
 try:
@@ -915,17 +1245,32 @@ try:
 except Exception as e:
     logger.warning(f"Не удалось подключить статические файлы: {e}")
 
+@app.on_event("startup")
+async def warmup():
+    """Прогрев: автомат ключевых слов и Tesseract готовы до первого запроса"""
+    
+    DocumentAnalyzer._get_keyword_automaton()
+    
+    try:
+        get_tess_api_pool()
+    except Exception as e:
+        logger.warning(f"Не удалось инициализировать Tesseract: {e}")
+
 # ============================================================================
 # API ENDPOINTS
 # ============================================================================
 
+# Главная страница отдается через StaticFiles (ETag/Last-Modified и ответ 304
+# на условные запросы) отдельным маршрутом, не перекрывая API
+main_page_files = StaticFiles(directory="static", html=True, check_dir=False)
+
 @app.get("/")
-async def get_main_page():
+async def get_main_page(request: Request):
     """Главная страница приложения"""
     try:
-        return FileResponse('static/index.html')
-    except FileNotFoundError:
-        return JSONResponse(
+        return await main_page_files.get_response("index.html", request.scope)
+    except StarletteHTTPException:
+        return ORJSONResponse(
             status_code=404,
             content={
                 "message": "Главная страница не найдена",
@@ -941,20 +1286,37 @@ async def analyze_document(file: UploadFile = File(...)):
     logger.info(f"Начат анализ файла: {file.filename}")
     
     try:
-        # Обработка файла
-        file_data = await FileProcessor.process_file(file)
+        # Прием файла
+        upload = await FileProcessor.receive_file(file)
+        
+        cache_key = (upload['digest'], upload['file_type'])
+        
+        try:
+            # Повторная загрузка того же содержимого - текст из кэша, без OCR и разбора PDF
+            file_data = text_cache.get(cache_key)
+            
+            if file_data is not None:
+                logger.info(f"Текст найден в кэше: {file.filename}")
+            else:
+                # Обработка файла
+                file_data = await FileProcessor.process_file(upload)
+                
+                if text_cache.getsizeof(file_data) <= text_cache.maxsize:
+                    text_cache[cache_key] = file_data
+        finally:
+            FileProcessor.remove_upload(upload)
         
-        # Анализ документа
+        # Анализ документа (для каждой загрузки свой ID и имя файла)
         analysis = DocumentAnalyzer.analyze(
             text=file_data['text'],
-            filename=file_data['filename'],
+            filename=upload['filename'],
             file_type=file_data['file_type'],
             file_size=file_data['file_size'],
             word_count=file_data['word_count']
         )
         
         # Сохранение в сессионное хранилище
-        session_storage[analysis.document_id] = analysis
+        await session_storage.set(analysis)
         
         logger.info(f"Анализ завершен: {analysis.document_id}")
         
@@ -975,11 +1337,12 @@ async def save_analysis(request: dict):
     if not document_id:
         raise HTTPException(status_code=400, detail="ID документа не указан")
     
-    if document_id not in session_storage:
+    analysis = await session_storage.get(document_id)
+    
+    if not analysis:
         raise HTTPException(status_code=404, detail="Документ не найден в сессии")
     
     try:
-        analysis = session_storage[document_id]
         file_path = document_manager.save_analysis(analysis)
         
         return {
@@ -1014,8 +1377,9 @@ async def get_document_analysis(document_id: str):
     """Получение результата анализа по ID"""
     
     # Сначала ищем в сессионном хранилище
-    if document_id in session_storage:
-        return session_storage[document_id]
+    analysis = await session_storage.get(document_id)
+    if analysis:
+        return analysis
     
     # Затем в сохраненных файлах
     analysis = document_manager.load_analysis(document_id)
@@ -1030,11 +1394,9 @@ async def chat_with_document(message: ChatMessage):
     """Чат с AI по документу"""
     
     # Поиск документа
-    analysis = None
+    analysis = await session_storage.get(message.document_id)
     
-    if message.document_id in session_storage:
-        analysis = session_storage[message.document_id]
-    else:
+    if not analysis:
         analysis = document_manager.load_analysis(message.document_id)
     
     if not analysis:
@@ -1064,7 +1426,7 @@ async def health_check():
         "service": "SafeDocs",
         "version": "2.0.0",
         "timestamp": datetime.now().isoformat(),
-        "session_documents": len(session_storage),
+        "session_documents": await session_storage.count(),
         "saved_documents": len(document_manager.get_saved_analyses())
     }
 
@@ -1090,7 +1452,7 @@ async def get_statistics():
         
         return {
             "total_documents": total_docs,
-            "session_documents": len(session_storage),
+            "session_documents": await session_storage.count(),
             "ratings_distribution": ratings_count,
             "average_risk_score": round(avg_risk_score, 2),
             "service_uptime": "running"
@@ -1101,37 +1463,44 @@ async def get_statistics():
         raise HTTPException(status_code=500, detail="Ошибка получения статистики")
 
 # Расширение DocumentAnalyzer для чата
-@staticmethod
-def _generate_chat_response(question: str, analysis: DocumentAnalysis) -> str:
-    """Генерация ответа в чате"""
-    
-    question_lower = question.lower()
-    
-    # Анализ типа вопроса и генерация ответа
-    if any(word in question_lower for word in ["риск", "опасн", "штраф", "проблем"]):
-        if analysis.risks:
-            risks_text = "\n".join([f"• {r.type}: {r.recommendation}" for r in analysis.risks[:3]])
-            return f"🚨 В документе обнаружены следующие риски:\n\n{risks_text}\n\nОбщий уровень риска: {analysis.risk_score}/100"
-        else:
-            return "✅ Серьезных рисков в документе не обнаружено."
-    
-    elif any(word in question_lower for word in ["выгод", "плюс", "хорош", "положительн"]):
-        if analysis.benefits:
-            benefits_text = "\n".join([f"• {b.type}: {b.description}" for b in analysis.benefits[:3]])
-            return f"✅ Выгодные условия в документе:\n\n{benefits_text}"
-        else:
-            return "❌ Явных выгодных условий не обнаружено."
-    
-    elif any(word in question_lower for word in ["непонятн", "неясн", "что означает", "расшифр"]):
-        if analysis.unclear_terms:
-            unclear_text = "\n".join([f"• {u.phrase}: {u.suggestion}" for u in analysis.unclear_terms[:3]])
-            return f"❓ Неясные формулировки в документе:\n\n{unclear_text}"
-        else:
-            return "✅ Все основные формулировки достаточно понятны."
-    
-    elif any(word in question_lower for word in ["подписывать", "согласиться", "стоит ли", "рекоменд"]):
-        recommendations_text = "\n".join([f"• {rec}" for rec in analysis.recommendations])
-        return f"""
+
+# Типы вопросов в чате: одно регулярное выражение вместо отдельного поиска каждого слова
+CHAT_INTENT_RE = re.compile(
+    r"(?P<risks>риск|опасн|штраф|проблем)"
+    r"|(?P<benefits>выгод|плюс|хорош|положительн)"
+    r"|(?P<unclear>непонятн|неясн|что означает|расшифр)"
+    r"|(?P<recommendation>подписывать|согласиться|стоит ли|рекоменд)"
+    r"|(?P<summary>резюме|итог|кратко|суть)"
+)
+
+def _chat_about_risks(analysis: DocumentAnalysis) -> str:
+    """Ответ о рисках"""
+    if analysis.risks:
+        risks_text = "\n".join([f"• {r.type}: {r.recommendation}" for r in analysis.risks[:3]])
+        return f"🚨 В документе обнаружены следующие риски:\n\n{risks_text}\n\nОбщий уровень риска: {analysis.risk_score}/100"
+    else:
+        return "✅ Серьезных рисков в документе не обнаружено."
+
+def _chat_about_benefits(analysis: DocumentAnalysis) -> str:
+    """Ответ о выгодных условиях"""
+    if analysis.benefits:
+        benefits_text = "\n".join([f"• {b.type}: {b.description}" for b in analysis.benefits[:3]])
+        return f"✅ Выгодные условия в документе:\n\n{benefits_text}"
+    else:
+        return "❌ Явных выгодных условий не обнаружено."
+
+def _chat_about_unclear_terms(analysis: DocumentAnalysis) -> str:
+    """Ответ о неясных формулировках"""
+    if analysis.unclear_terms:
+        unclear_text = "\n".join([f"• {u.phrase}: {u.suggestion}" for u in analysis.unclear_terms[:3]])
+        return f"❓ Неясные формулировки в документе:\n\n{unclear_text}"
+    else:
+        return "✅ Все основные формулировки достаточно понятны."
+
+def _chat_about_recommendation(analysis: DocumentAnalysis) -> str:
+    """Ответ о целесообразности подписания"""
+    recommendations_text = "\n".join([f"• {rec}" for rec in analysis.recommendations])
+    return f"""
 🤔 Рекомендация по документу "{analysis.filename}":
 
 📊 Общая оценка: {analysis.overall_rating}
@@ -1141,13 +1510,15 @@ def _generate_chat_response(question: str, analysis: DocumentAnalysis) -> str:
 {recommendations_text}
 
 ⚖️ Окончательное решение остается за вами. При наличии сомнений рекомендуется консультация с юристом.
-        """.strip()
-    
-    elif any(word in question_lower for word in ["резюме", "итог", "кратко", "суть"]):
-        return analysis.summary
-    
-    else:
-        return f"""
+    """.strip()
+
+def _chat_about_summary(analysis: DocumentAnalysis) -> str:
+    """Краткое резюме документа"""
+    return analysis.summary
+
+def _chat_default(analysis: DocumentAnalysis) -> str:
+    """Ответ на вопрос без распознанного типа"""
+    return f"""
 💬 Спасибо за вопрос! 
 
 Я могу помочь с анализом документа "{analysis.filename}":
@@ -1167,6 +1538,28 @@ def _generate_chat_response(question: str, analysis: DocumentAnalysis) -> str:
 🤖 Система постоянно улучшается для предоставления более точных ответов.
         """
 
+# Обработчики в порядке приоритета типов вопросов
+CHAT_INTENT_HANDLERS = {
+    "risks": _chat_about_risks,
+    "benefits": _chat_about_benefits,
+    "unclear": _chat_about_unclear_terms,
+    "recommendation": _chat_about_recommendation,
+    "summary": _chat_about_summary,
+}
+
+@staticmethod
+def _generate_chat_response(question: str, analysis: DocumentAnalysis) -> str:
+    """Генерация ответа в чате"""
+    
+    # Анализ типа вопроса за один проход и выбор обработчика
+    found_intents = {match.lastgroup for match in CHAT_INTENT_RE.finditer(question.lower())}
+    
+    for intent, handler in CHAT_INTENT_HANDLERS.items():
+        if intent in found_intents:
+            return handler(analysis)
+    
+    return _chat_default(analysis)
+
 # Добавление метода в класс
 DocumentAnalyzer._generate_chat_response = _generate_chat_response
 